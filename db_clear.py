@@ -4,6 +4,10 @@
 import box
 import yaml
 import os
+import sys
+import argparse
+from src.shards import get_collection_paths, get_parent_child_path, list_collections
+from src.textcache import clear_cache, prune_cache
 
 # Import config vars
 with open('config/config.yml', 'r', encoding='utf8') as ymlfile:
@@ -34,7 +38,35 @@ def delete_files_and_clear_content(folder_path, file_to_clear):
         print(f"{file_to_clear} not found.")
 
 if __name__ == "__main__":
-    folder_path = cfg.DB_FAISS_PATH
-    file_to_clear = os.path.join(cfg.DATA_PATH, cfg.LOG_FILE)
-    
-    delete_files_and_clear_content(folder_path, file_to_clear)
\ No newline at end of file
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--collections',
+                        nargs='+',
+                        help="Only clear these collections. Defaults to every built collection")
+    parser.add_argument('--prune-cache',
+                        action='store_true',
+                        help="Remove extracted text of files that are no longer in the data folder from the text cache. Collections are kept unless --collections is given")
+    parser.add_argument('--clear-cache',
+                        action='store_true',
+                        help="Remove all extracted text from the text cache, files are parsed again on the next build. Collections are kept unless --collections is given")
+    args = parser.parse_args()
+
+    # The extracted text cache is kept by default, so rebuilding doesn't need to parse the files again
+    if args.clear_cache:
+        print(f"{clear_cache()} files removed from the text cache.")
+    elif args.prune_cache:
+        print(f"{prune_cache()} files removed from the text cache.")
+
+    # Cache maintenance leaves the built collections alone, unless collections are named explicitly
+    if (args.clear_cache or args.prune_cache) and not args.collections:
+        sys.exit()
+
+    collections = args.collections or sorted(set(list_collections()) | set(list_collections(childparent=True)))
+    for name in collections:
+        data_path, folder_path = get_collection_paths(name)
+        file_to_clear = os.path.join(data_path, cfg.LOG_FILE)
+
+        delete_files_and_clear_content(folder_path, file_to_clear)
+
+        # Child and parent chunks are stored in a subfolder of the collection
+        if os.path.isdir(get_parent_child_path(name)):
+            delete_files_and_clear_content(get_parent_child_path(name), file_to_clear)
\ No newline at end of file
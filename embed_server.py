@@ -0,0 +1,69 @@
+# =========================
+#  Module: Embedding server
+# =========================
+import box, yaml, os, json, socketserver
+from src.utils import load_local_embeddings
+from src.embedding_service import MicroBatcher, recv_message, send_message
+import argparse
+
+
+# Import config vars
+with open('config/config.yml', 'r', encoding='utf8') as ymlfile:
+    cfg = box.Box(yaml.safe_load(ymlfile))
+
+# Handles one client connection
+class _Handler(socketserver.BaseRequestHandler):
+    def handle(self):
+        # A connection can send several requests, it is closed by the client when done
+        while True:
+            try:
+                request = json.loads(recv_message(self.request))
+            except ConnectionError:
+                return
+            except ValueError as e:
+                # The rest of the stream can't be trusted after a malformed request, so the connection is closed
+                send_message(self.request, json.dumps({'error': f"Malformed request: {e}"}).encode('utf8'))
+                return
+            try:
+                vectors = self.server.batcher.embed(request['texts'])
+            except Exception as e:
+                send_message(self.request, json.dumps({'error': str(e)}).encode('utf8'))
+                continue
+            send_message(self.request, json.dumps({'shape': list(vectors.shape)}).encode('utf8'))
+            send_message(self.request, vectors.tobytes())
+
+
+# Loads the embeddings once and shares them with every process that calls load_embeddings()
+class EmbeddingServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, embeddings, socket_path=cfg.EMBEDDING_SOCKET):
+        # Remove the socket of a previous server that did not shut down cleanly
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        super().__init__(socket_path, _Handler)
+        self.socket_path = socket_path
+        self.batcher = MicroBatcher(embeddings)
+
+    def server_close(self):
+        super().server_close()
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--socket',
+                        default=cfg.EMBEDDING_SOCKET,
+                        help="Unix socket to listen on")
+    args = parser.parse_args()
+
+    print("Loading embeddings ...")
+    server = EmbeddingServer(load_local_embeddings(), args.socket)
+    print(f"Embedding service listening on ./{args.socket}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
@@ -0,0 +1,194 @@
+# =========================
+#  Module: Retrieval evaluation
+# =========================
+import box, yaml, timeit, os, csv, json, math, tempfile
+import faiss
+import numpy as np
+from langchain.text_splitter import RecursiveCharacterTextSplitter
+from src.utils import load_embeddings, load_documents
+from src.shards import get_collection_paths
+from src.parentchild import ParentChildIndex
+import argparse
+
+
+# Import config vars
+with open('config/config.yml', 'r', encoding='utf8') as ymlfile:
+    cfg = box.Box(yaml.safe_load(ymlfile))
+
+with open('config/eval.yml', 'r', encoding='utf8') as ymlfile:
+    eval_cfg = box.Box(yaml.safe_load(ymlfile))
+
+# Questions without expected sources can't be scored, so they are skipped
+def load_questions(path):
+    with open(path, 'r', encoding='utf8') as file:
+        questions = [json.loads(line) for line in file if line.strip()]
+    for question in questions:
+        if not question.get('sources'):
+            print(f"Skipping question without sources: {question.get('question')}")
+    return [question for question in questions if question.get('sources')]
+
+# A chunk is relevant when its file (and page, if the label has one) is one of the expected sources
+def is_relevant(metadata, expected_source):
+    file_name, _, page = expected_source.partition(':')
+    if os.path.basename(metadata.get('source', '')) != file_name:
+        return False
+    return not page or ('page' in metadata and int(page) == metadata['page'] + 1)
+
+def score_results(results, questions, k_values):
+    scores = {}
+    for k in k_values:
+        recall = 0
+        for retrieved, question in zip(results, questions):
+            expected = question['sources']
+            found = [source for source in expected if any(is_relevant(metadata, source) for metadata in retrieved[:k])]
+            recall += len(found) / len(expected)
+        scores[f'recall@{k}'] = recall / len(questions)
+
+    reciprocal_ranks = []
+    for retrieved, question in zip(results, questions):
+        ranks = [rank for rank, metadata in enumerate(retrieved, start=1)
+                 if any(is_relevant(metadata, source) for source in question['sources'])]
+        reciprocal_ranks.append(1 / ranks[0] if ranks else 0)
+    scores['mrr'] = sum(reciprocal_ranks) / len(questions)
+    return scores
+
+def build_index(vectors, factory, nprobe=None):
+    index = faiss.index_factory(vectors.shape[1], factory.format(nlist=max(1, int(math.sqrt(len(vectors))))))
+    if not index.is_trained:
+        index.train(vectors)
+    index.add(vectors)
+    if nprobe:
+        faiss.ParameterSpace().set_index_parameter(index, 'nprobe', nprobe)
+    return index
+
+def time_queries(search, query_vectors):
+    results, latencies = [], []
+    for vector in query_vectors:
+        start = timeit.default_timer()
+        results.append(search(vector))
+        latencies.append((timeit.default_timer() - start) * 1000)
+    return results, latencies
+
+# Regular chunks: returns the result row, the metadata of the chunks found per question and the query latencies
+def evaluate_chunks(variant, documents, embeddings, query_vectors, k):
+    start = timeit.default_timer()
+    text_splitter = RecursiveCharacterTextSplitter(chunk_size=variant.chunk_size,
+                                                   chunk_overlap=variant.chunk_overlap)
+    chunks = text_splitter.split_documents(documents)
+    vectors = np.array(embeddings.embed_documents([chunk.page_content for chunk in chunks]), dtype='float32')
+    index = build_index(vectors, variant.get('index', 'Flat'), variant.get('nprobe'))
+    build_time = timeit.default_timer() - start
+
+    def search(vector):
+        _, ids = index.search(np.array([vector], dtype='float32'), k)
+        return [int(i) for i in ids[0] if i != -1]
+    ids, latencies = time_queries(search, query_vectors)
+
+    # Exact (brute-force) search over the same vectors is the ground truth for approximate indexes
+    exact_recall = None
+    if variant.get('index', 'Flat') != 'Flat':
+        exact_index = build_index(vectors, 'Flat')
+        _, exact_ids = exact_index.search(np.array(query_vectors, dtype='float32'), k)
+        exact_recall = np.mean([len(set(found) & set(exact)) / k for found, exact in zip(ids, exact_ids.tolist())])
+
+    result = {'chunks': len(chunks),
+              'build_s': build_time,
+              'size_mb': faiss.serialize_index(index).nbytes / 1e6,
+              'exact@k': exact_recall}
+    return result, [[chunks[i].metadata for i in found] for found in ids], latencies
+
+# Child and parent chunks, built with the same index as db_build.py --childparent
+def evaluate_childparent(variant, documents, embeddings, query_vectors, k):
+    with tempfile.TemporaryDirectory() as path:
+        index = ParentChildIndex(
+            path, embeddings,
+            parent_splitter=RecursiveCharacterTextSplitter(chunk_size=variant.parent_chunk_size,
+                                                           chunk_overlap=variant.parent_chunk_overlap),
+            child_splitter=RecursiveCharacterTextSplitter(chunk_size=variant.child_chunk_size,
+                                                          chunk_overlap=variant.child_chunk_overlap))
+        start = timeit.default_timer()
+        index.add_documents(documents)
+        build_time = timeit.default_timer() - start
+
+        def search(vector):
+            return [doc.metadata for doc, _ in index.similarity_search_with_score_by_vector(vector, k=k)]
+        retrieved, latencies = time_queries(search, query_vectors)
+
+        result = {'chunks': len(index.child_parents),
+                  'build_s': build_time,
+                  'size_mb': sum(os.path.getsize(os.path.join(path, file)) for file in os.listdir(path)) / 1e6,
+                  'exact@k': None}
+    return result, retrieved, latencies
+
+def print_table(rows, columns):
+    def fmt(value):
+        if value is None:
+            return '-'
+        return f"{value:.3f}" if isinstance(value, float) else str(value)
+
+    widths = [max(len(column), *(len(fmt(row[column])) for row in rows)) for column in columns]
+    print("  ".join(column.ljust(width) for column, width in zip(columns, widths)))
+    for row in rows:
+        print("  ".join(fmt(row[column]).ljust(width) for column, width in zip(columns, widths)))
+
+def run_eval(collection, variant_names=None, output=None):
+    if not os.path.isfile(eval_cfg.QUESTIONS_PATH):
+        print(f"No questions found, add them to ./{eval_cfg.QUESTIONS_PATH}")
+        return
+    questions = load_questions(eval_cfg.QUESTIONS_PATH)
+    if not questions:
+        print(f"No questions to evaluate in ./{eval_cfg.QUESTIONS_PATH}")
+        return
+    k_values = sorted(eval_cfg.K_VALUES)
+    k = k_values[-1]
+    variants = [variant for variant in eval_cfg.VARIANTS if not variant_names or variant.name in variant_names]
+    if not variants:
+        print("No variants to evaluate")
+        return
+
+    # All variants are built from the same extracted text
+    source, _ = get_collection_paths(collection)
+    files = [file for file in os.listdir(source)
+             if os.path.isfile(os.path.join(source, file)) and file != cfg.LOG_FILE]
+    documents = load_documents(source, files)
+    print(f"Loaded {len(files)} files and {len(questions)} questions")
+
+    print("Loading embeddings ...")
+    embeddings = load_embeddings()
+    # Embedding the questions is the same for every variant, so it is left out of the query latency
+    query_vectors = [embeddings.embed_query(question['question']) for question in questions]
+
+    rows = []
+    for variant in variants:
+        print(f"Evaluating variant '{variant.name}' ...")
+        evaluate = evaluate_childparent if variant.get('childparent') else evaluate_chunks
+        result, retrieved, latencies = evaluate(variant, documents, embeddings, query_vectors, k)
+        rows.append({'variant': variant.name,
+                     **result,
+                     **score_results(retrieved, questions, k_values),
+                     'query_ms': float(np.mean(latencies)),
+                     'p95_ms': float(np.percentile(latencies, 95))})
+
+    columns = ['variant', 'chunks', 'build_s', 'size_mb', *[f'recall@{k}' for k in k_values], 'mrr',
+               'exact@k', 'query_ms', 'p95_ms']
+    print_table(rows, columns)
+
+    if output:
+        with open(output, 'w', newline='', encoding='utf8') as file:
+            writer = csv.DictWriter(file, fieldnames=columns)
+            writer.writeheader()
+            writer.writerows(rows)
+        print(f"Saved results to ./{output}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--collection',
+                        default=cfg.DEFAULT_COLLECTION,
+                        help="Collection whose files are used to build the variants")
+    parser.add_argument('--variants',
+                        nargs='+',
+                        help="Only evaluate these variants from config/eval.yml")
+    parser.add_argument('--output',
+                        help="Also save the results to this CSV file")
+    args = parser.parse_args()
+    run_eval(args.collection, args.variants, args.output)
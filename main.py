@@ -1,10 +1,11 @@
-import box, timeit, yaml, os
+import box, timeit, yaml, os, gc
 from dotenv import find_dotenv, load_dotenv
 from src.prompts import qa_template
 from src.utils import generate_user_input_options, load_embeddings 
 from src.llm import get_conversation_chain
 from langchain.memory import ConversationBufferMemory
-from langchain.vectorstores import FAISS
+from src.shards import list_collections, load_collections
+from src.budget import LatencyBudget
 import argparse
 
 # Load environment variables from .env file
@@ -24,6 +25,13 @@ if __name__ == "__main__":
     parser.add_argument('--childparent',
                         action='store_true',
                         help="Choose whether to retrieve Child and Parent chunks or regular chunks")
+    parser.add_argument('--collections',
+                        nargs='+',
+                        help="Collections to search in. If omitted you are asked to choose")
+    parser.add_argument('--budget',
+                        type=float,
+                        default=cfg.LATENCY_BUDGET,
+                        help="Latency budget in seconds per question, later stages are cut short when it runs out (0 = no budget)")
     args = parser.parse_args()
     
     while True:
@@ -46,9 +54,21 @@ if __name__ == "__main__":
         else: # If there is only one model, use that one
             selected_file = files[0]
 
-        # if childparent chunks aren't used, load the embeddings for use in vectorstore setup
-        if not args.childparent:
-            embeddings = load_embeddings()
+        # Load the embeddings for use in vectorstore setup
+        embeddings = load_embeddings()
+
+        # If there is more than one collection, let user choose which ones to search in
+        collections = args.collections or list_collections(args.childparent)
+        if not args.collections and len(collections) > 1:
+            options = "\n".join(f"Option {i+1}: {name}" for i, name in enumerate(collections))
+            user_choice = input(f"Which collections do you want me to search? Separate options with a comma (or press Enter for all): \n{options}\n")
+            if user_choice:
+                try:
+                    collections = [collections[int(choice) - 1] for choice in user_choice.split(',')]
+                except (ValueError, IndexError):
+                    print("Invalid choice")
+                    break
+            print(f"Selected collections: {', '.join(collections)}")
 
         memory = ConversationBufferMemory(
             input_key='question', output_key='answer',
@@ -58,6 +78,11 @@ if __name__ == "__main__":
         
         if question:
             start = timeit.default_timer()
+            budget = LatencyBudget(args.budget) if args.budget > 0 else None
+
+            # Unload the previous model first, so two models are never in memory at once
+            conversation = None
+            gc.collect()
 
             conversation = get_conversation_chain(
                 os.path.join(model_path, selected_file),
@@ -65,9 +90,10 @@ if __name__ == "__main__":
                 temp=0,
                 gpu_layers=0,
                 n_sources=cfg.VECTOR_COUNT,
-                vectorstore=FAISS.load_local(cfg.DB_FAISS_PATH, embeddings) if not args.childparent else None,
+                vectorstore=load_collections(collections, embeddings, childparent=args.childparent),
                 memory=memory,
-                prompt=qa_template 
+                prompt=qa_template,
+                budget=budget
                 )
             
             response = conversation(
@@ -91,6 +117,8 @@ if __name__ == "__main__":
 
             time =  f"{round((end-start)/60)} minutes" if (end-start) > 100 else f"{round(end-start)} seconds"
             print(f"Time to retrieve response: {time}")
+            if response['degradations']:
+                print(f"Latency budget degradations: {', '.join(response['degradations'])}")
             print("="* 60)
         
         cont = input("Do you want to provide input again? (y/n): ")
@@ -0,0 +1,204 @@
+'''
+===========================================
+        Module: Latency budget
+===========================================
+'''
+import box, yaml, timeit, inspect, math, logging
+from typing import Any, Callable, Dict, List, Optional
+from langchain.callbacks.base import BaseCallbackHandler
+from langchain.callbacks.manager import AsyncCallbackManagerForChainRun, CallbackManagerForChainRun
+from langchain.chains import ConversationalRetrievalChain
+from langchain.chains.conversational_retrieval.base import _get_chat_history
+from src.speculative import SpeculativeRetrieval, get_embed_query
+
+# Import config vars
+with open('config/config.yml', 'r', encoding='utf8') as ymlfile:
+    cfg = box.Box(yaml.safe_load(ymlfile))
+
+
+class BudgetExceeded(Exception):
+    """Raised from a streaming callback to stop the LLM from generating any further."""
+
+
+# LangChain logs every exception raised from a callback as an error before re-raising it. Stopping
+# on the budget is expected, so those records are dropped.
+class _BudgetExceededFilter(logging.Filter):
+    def filter(self, record: logging.LogRecord) -> bool:
+        return BudgetExceeded.__name__ not in record.getMessage()
+
+logging.getLogger('langchain.callbacks.manager').addFilter(_BudgetExceededFilter())
+
+
+class LatencyBudget:
+    """Time a single request is allowed to take, counting from the moment it is created.
+
+    `should_cancel` is an optional function that returns True once nobody is waiting for
+    the answer anymore (e.g. the client disconnected).
+    """
+
+    def __init__(self, seconds: float, should_cancel: Optional[Callable[[], bool]] = None):
+        self.seconds = seconds
+        self.should_cancel = should_cancel
+        self.start = timeit.default_timer()
+        self.degradations = []
+
+    def elapsed(self) -> float:
+        return timeit.default_timer() - self.start
+
+    def remaining(self) -> float:
+        return self.seconds - self.elapsed()
+
+    def cancelled(self) -> bool:
+        return self.should_cancel is not None and self.should_cancel()
+
+    def degrade(self, degradation: str):
+        if degradation not in self.degradations:
+            self.degradations.append(degradation)
+
+
+class BudgetCallbackHandler(BaseCallbackHandler):
+    """Stops streaming once the budget is spent, at the end of a sentence if `sentence_stop` is set.
+
+    Keeps the streamed text, so whatever was generated before stopping can still be used.
+    raise_error makes LangChain pass BudgetExceeded on to the chain instead of only logging it.
+    """
+    raise_error = True
+
+    def __init__(self, budget: LatencyBudget, sentence_stop: bool = True):
+        self.budget = budget
+        self.sentence_stop = sentence_stop
+        self.text = ""
+
+    def on_llm_start(self, serialized: Dict[str, Any], prompts: List[str], **kwargs: Any):
+        self.text = ""
+
+    def on_llm_new_token(self, token: str, **kwargs: Any):
+        self.text += token
+        if self.budget.cancelled():
+            self.budget.degrade('cancelled')
+            raise BudgetExceeded()
+
+        overdue = -self.budget.remaining()
+        if overdue <= 0:
+            return
+        # Allow a short grace period to finish the current sentence
+        end_of_sentence = token.rstrip().endswith(('.', '!', '?'))
+        if not self.sentence_stop or end_of_sentence or overdue > cfg.BUDGET_GRACE:
+            self.budget.degrade('early_stop')
+            raise BudgetExceeded()
+
+
+class BudgetedConversationalRetrievalChain(ConversationalRetrievalChain):
+    """ConversationalRetrievalChain that degrades its later stages when the latency budget runs low:
+    - the question is not condensed when less than BUDGET_MIN_CONDENSE seconds are left
+    - half of the sources are used when less than BUDGET_MIN_SOURCES seconds are left
+    - max_tokens is capped to what can be generated in the remaining time
+    - generation stops at the end of a sentence once the budget is spent, or right away on cancel
+    The applied degradations are returned under 'degradations'.
+
+    With SPECULATIVE_RETRIEVAL set, sources for the raw follow-up question are already retrieved
+    while the question is condensed.
+    """
+    budget: Optional[LatencyBudget] = None
+
+    @property
+    def output_keys(self) -> List[str]:
+        return super().output_keys + ['degradations']
+
+    def _call(self, inputs: Dict[str, Any], run_manager: Optional[CallbackManagerForChainRun] = None) -> Dict[str, Any]:
+        # Without a budget nothing is degraded
+        budget = self.budget or LatencyBudget(math.inf)
+        _run_manager = run_manager or CallbackManagerForChainRun.get_noop_manager()
+        question = inputs['question']
+        get_chat_history = self.get_chat_history or _get_chat_history
+        chat_history_str = get_chat_history(inputs['chat_history'])
+
+        # Stage 1: condense the follow-up question, while already retrieving for the raw question
+        new_question = question
+        speculative = None
+        if chat_history_str:
+            if budget.remaining() < cfg.BUDGET_MIN_CONDENSE:
+                budget.degrade('skipped_condense')
+            else:
+                store = getattr(self.retriever, 'store', None) or getattr(self.retriever, 'vectorstore', None)
+                embed_query = get_embed_query(store)
+                # Other search types (mmr, score threshold) are left to the retriever
+                if (cfg.SPECULATIVE_RETRIEVAL and embed_query is not None
+                        and getattr(self.retriever, 'search_type', 'similarity') == 'similarity'
+                        and hasattr(store, 'similarity_search_with_score_by_vector')):
+                    speculative = SpeculativeRetrieval(store, embed_query, self.retriever.search_kwargs)
+                    speculative.start(question)
+
+                handler = BudgetCallbackHandler(budget, sentence_stop=False)
+                try:
+                    new_question = self.question_generator.run(
+                        question=question, chat_history=chat_history_str, callbacks=self._with_handler(_run_manager, handler))
+                except BudgetExceeded:
+                    budget.degrade('interrupted_condense')
+
+        # Stage 2: retrieve sources
+        docs = []
+        if not budget.cancelled():
+            # A speculative miss is retrieved through the retriever, like without speculation
+            docs = speculative.resolve(new_question) if speculative is not None else None
+            if docs is not None:
+                docs = self._reduce_tokens_below_limit(docs)
+            elif 'run_manager' in inspect.signature(self._get_docs).parameters:
+                docs = self._get_docs(new_question, inputs, run_manager=_run_manager)
+            else:
+                docs = self._get_docs(new_question, inputs)
+            if budget.remaining() < cfg.BUDGET_MIN_SOURCES and len(docs) > 1:
+                n_sources = max(1, len(docs) // 2)
+                budget.degrade(f'sources {len(docs)}->{n_sources}')
+                docs = docs[:n_sources]
+
+        # Stage 3: generate the answer
+        output = {}
+        if budget.cancelled():
+            budget.degrade('cancelled')
+            output[self.output_key] = ""
+        elif self.response_if_no_docs_found is not None and len(docs) == 0:
+            output[self.output_key] = self.response_if_no_docs_found
+        else:
+            new_inputs = inputs.copy()
+            if self.rephrase_question:
+                new_inputs['question'] = new_question
+            new_inputs['chat_history'] = chat_history_str
+            output[self.output_key] = self._generate(docs, new_inputs, _run_manager, budget)
+
+        if self.return_source_documents:
+            output['source_documents'] = docs
+        if self.return_generated_question:
+            output['generated_question'] = new_question
+        output['degradations'] = list(budget.degradations)
+        return output
+
+    # The inherited async path doesn't apply the budget or return 'degradations', which fails output validation
+    async def _acall(self, inputs: Dict[str, Any], run_manager: Optional[AsyncCallbackManagerForChainRun] = None) -> Dict[str, Any]:
+        raise NotImplementedError(f"{self.__class__.__name__} does not support async calls, use run() or __call__() instead")
+
+    def _generate(self, docs, inputs, run_manager, budget):
+        llm = self.combine_docs_chain.llm_chain.llm
+        max_tokens = llm.max_tokens
+
+        # Cap the answer length to what fits in the remaining time
+        if math.isfinite(budget.remaining()):
+            token_cap = max(cfg.BUDGET_MIN_TOKENS, int(budget.remaining() * cfg.BUDGET_TOKENS_PER_SECOND))
+            if max_tokens is None or token_cap < max_tokens:
+                budget.degrade(f'max_tokens {max_tokens}->{token_cap}')
+                llm.max_tokens = token_cap
+
+        handler = BudgetCallbackHandler(budget)
+        try:
+            return self.combine_docs_chain.run(
+                input_documents=docs, callbacks=self._with_handler(run_manager, handler), **inputs)
+        except BudgetExceeded:
+            return handler.text
+        finally:
+            llm.max_tokens = max_tokens
+
+    @staticmethod
+    def _with_handler(run_manager, handler):
+        callbacks = run_manager.get_child()
+        callbacks.add_handler(handler)
+        return callbacks
@@ -1,22 +1,29 @@
-import os
+import box, yaml, os
 import streamlit as st
 from src.prompts import qa_template
 from src.utils import generate_user_input_options, get_vectorstore, clear_chat_history, reset_prompt
+from src.memory import MB, ModelMemoryPlan, estimate_embeddings, estimate_vectorstore, process_memory
 from langchain.memory import ConversationBufferMemory
 
+# Import config vars
+with open('config/config.yml', 'r', encoding='utf8') as ymlfile:
+    cfg = box.Box(yaml.safe_load(ymlfile))
 
 class MainVisuals:
-    def __init__(self, title, path, type=None, show_sources=False):
+    def __init__(self, title, path, type=None, show_sources=False, collections=None):
         self.title = title
         self.path = path
         self.type = type
         self.show_sources = show_sources
+        self.collections = collections
+        self.selected_collections = None
         self.file = None
         self.selected_model = None
         self.gpu_layers = None
         self.temp = None
         self.length = None
         self.n_sources = None
+        self.budget = None
 
     def render(self):
         # Set app title and header
@@ -41,6 +48,10 @@ class MainVisuals:
             choose_model = st.selectbox('Choose a model', files, key='choose_model')
             self.selected_model = os.path.join(model_path, choose_model)
 
+            if self.collections:
+                self.selected_collections = st.multiselect('Choose collections to search', self.collections, 
+                                                           default=self.collections, key='choose_collections')
+
             if self.type == 'pdf': 
                 st.subheader("Your PDF documents")
                 pdf_docs = st.file_uploader(
@@ -82,6 +93,14 @@ class MainVisuals:
             self.length = col12.slider('max_length', min_value=32, max_value=512, value=256, step=8, 
             help="This controls the amount of tokens the model is allowed to give as a response")      
 
+            if self.show_sources:
+                self.budget = st.slider('latency_budget (seconds)', min_value=0, max_value=600, value=cfg.LATENCY_BUDGET, step=10,
+                help='''
+                Time each answer is allowed to take, 0 means no limit.  
+                *When time runs short, fewer sources and shorter answers are used*
+                '''
+                )
+
             if self.type != 'csv':
                 # Text area for adjusting prompts
                 st.session_state.text_prompt = st.text_area('Prompt before the chat starts. Edit here if desired:', 
@@ -96,3 +115,24 @@ class MainVisuals:
                 col22.button('Clear Chat History', use_container_width=True, on_click=clear_chat_history)
             else:
                 st.button('Clear Chat History', use_container_width=True, on_click=clear_chat_history)
+
+    def render_memory(self, vectorstore=None, embeddings=None):
+        # Live breakdown of the memory used by the selected model, the index and the embeddings
+        # Context size the model was loaded with, which can be lower than N_CTX when memory is short
+        n_ctx = st.session_state.get('admitted_ctx', {}).get(self.selected_model, cfg.N_CTX)
+        plan = ModelMemoryPlan(self.selected_model, n_ctx)
+        breakdown = {'Model weights': plan.model_bytes(), 
+                     f'KV cache (n_ctx={n_ctx})': plan.kv_cache_bytes()}
+        if embeddings is not None:
+            breakdown['Embedding model'] = estimate_embeddings(embeddings)
+        if vectorstore is not None:
+            breakdown['Vector index'] = estimate_vectorstore(vectorstore)
+
+        with st.sidebar.expander('Memory'):
+            for name, size in breakdown.items():
+                st.markdown(f"{name}: {size // MB} MB")
+            rss = process_memory()
+            if rss is not None:
+                st.markdown(f"Used by this app: {rss // MB} MB")
+            if plan.available is not None:
+                st.markdown(f"Available: {plan.available // MB} MB")
@@ -0,0 +1,95 @@
+'''
+===========================================
+        Module: Coarse-to-fine retrieval
+===========================================
+'''
+import box, yaml, os, json
+from typing import List
+import faiss
+import numpy as np
+from langchain.embeddings.base import Embeddings
+from langchain.schema import Document
+from langchain.vectorstores import FAISS
+
+# Import config vars
+with open('config/config.yml', 'r', encoding='utf8') as ymlfile:
+    cfg = box.Box(yaml.safe_load(ymlfile))
+
+# Chunks of a file are added to the index one after the other, so every file covers a range of chunk ids.
+# Each range is represented by the normalised centroid of its chunk vectors in a small document index.
+def build_document_index(store: FAISS, db_path):
+    ranges = []
+    for i in range(store.index.ntotal):
+        source = store.docstore.search(store.index_to_docstore_id[i]).metadata.get('source')
+        if ranges and ranges[-1]['source'] == source:
+            ranges[-1]['count'] += 1
+        else:
+            ranges.append({'source': source, 'start': i, 'count': 1})
+
+    centroids = np.array([store.index.reconstruct_n(item['start'], item['count']).mean(axis=0) for item in ranges],
+                         dtype='float32')
+    centroids /= np.maximum(np.linalg.norm(centroids, axis=1, keepdims=True), 1e-12)
+    document_index = faiss.IndexFlatL2(store.index.d)
+    document_index.add(centroids)
+
+    faiss.write_index(document_index, os.path.join(db_path, 'documents.faiss'))
+    with open(os.path.join(db_path, 'documents.json'), 'w', encoding='utf8') as file:
+        json.dump(ranges, file)
+
+
+class CoarseToFineFAISS:
+    """FAISS store that first picks the `n_documents` closest documents and then only searches their chunks."""
+
+    def __init__(self, store: FAISS, embeddings: Embeddings, document_index, ranges, n_documents=cfg.COARSE_DOCUMENTS):
+        self.store = store
+        self.embeddings = embeddings
+        self.document_index = document_index
+        self.ranges = ranges
+        self.n_documents = n_documents
+        self.index = store.index
+        self.docstore = store.docstore
+
+    @classmethod
+    def load(cls, db_path, store: FAISS, embeddings: Embeddings, **kwargs):
+        document_index = faiss.read_index(os.path.join(db_path, 'documents.faiss'))
+        with open(os.path.join(db_path, 'documents.json'), 'r', encoding='utf8') as file:
+            ranges = json.load(file)
+        return cls(store, embeddings, document_index, ranges, **kwargs)
+
+    def similarity_search_with_score_by_vector(self, embedding: List[float], k: int = 4, **kwargs) -> List[tuple]:
+        # Nothing to skip when there are only a few documents. Filters (filter, fetch_k, ...) are left to FAISS,
+        # they can remove chunks of the selected documents and leave fewer than k results.
+        if self.n_documents >= len(self.ranges) or kwargs:
+            return self.store.similarity_search_with_score_by_vector(embedding, k=k, **kwargs)
+
+        # Take more documents until their chunks cover at least k results
+        query = np.array([embedding], dtype='float32')
+        n_documents = self.n_documents
+        while True:
+            _, document_ids = self.document_index.search(query, n_documents)
+            selected = [self.ranges[i] for i in document_ids[0] if i != -1]
+            if sum(item['count'] for item in selected) >= k:
+                break
+            if n_documents >= len(self.ranges):
+                return self.store.similarity_search_with_score_by_vector(embedding, k=k)
+            n_documents = min(n_documents * 2, len(self.ranges))
+
+        # Exact search over the chunks of the selected documents only
+        ids = np.concatenate([np.arange(item['start'], item['start'] + item['count']) for item in selected])
+        vectors = np.vstack([self.index.reconstruct_n(item['start'], item['count']) for item in selected])
+        distances = ((vectors - query) ** 2).sum(axis=1)
+        top = np.argsort(distances)[:k]
+
+        results = []
+        for i in top:
+            doc = self.docstore.search(self.store.index_to_docstore_id[int(ids[i])])
+            if isinstance(doc, Document):
+                results.append((doc, float(distances[i])))
+        return results
+
+    def similarity_search_with_score(self, query: str, k: int = 4, **kwargs) -> List[tuple]:
+        embedding = self.embeddings.embed_query(query)
+        return self.similarity_search_with_score_by_vector(embedding, k=k, **kwargs)
+
+    def similarity_search(self, query: str, k: int = 4, **kwargs) -> List[Document]:
+        return [doc for doc, _ in self.similarity_search_with_score(query, k=k, **kwargs)]
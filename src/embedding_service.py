@@ -0,0 +1,133 @@
+'''
+===========================================
+        Module: Embedding service
+===========================================
+'''
+import box, yaml, os, json, queue, socket, struct, threading, timeit
+from typing import List
+import numpy as np
+from langchain.embeddings.base import Embeddings
+
+# Import config vars
+with open('config/config.yml', 'r', encoding='utf8') as ymlfile:
+    cfg = box.Box(yaml.safe_load(ymlfile))
+
+# Every message is prefixed with its length. A request is a JSON message {"texts": [...]},
+# a response is a JSON header {"shape": [rows, dim]} or {"error": "..."} followed by the raw float32 vectors.
+def send_message(sock, payload: bytes):
+    sock.sendall(struct.pack('!I', len(payload)) + payload)
+
+def _recv_exact(sock, size):
+    data = bytearray()
+    while len(data) < size:
+        part = sock.recv(size - len(data))
+        if not part:
+            raise ConnectionError("Embedding service connection closed")
+        data.extend(part)
+    return bytes(data)
+
+def recv_message(sock) -> bytes:
+    size, = struct.unpack('!I', _recv_exact(sock, 4))
+    return _recv_exact(sock, size)
+
+def service_available(socket_path=cfg.EMBEDDING_SOCKET):
+    if not hasattr(socket, 'AF_UNIX') or not os.path.exists(socket_path):
+        return False
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.connect(socket_path)
+        return True
+    except OSError:
+        return False
+
+
+class EmbeddingClient(Embeddings):
+    """Embeddings that are computed by the shared embedding service instead of in this process.
+
+    Large document lists are sent in parts of at most `max_batch` texts, so queries of other
+    callers can be batched in between.
+    """
+
+    def __init__(self, socket_path=cfg.EMBEDDING_SOCKET, max_batch=cfg.EMBEDDING_MAX_BATCH):
+        self.socket_path = socket_path
+        self.max_batch = max_batch
+
+    def _embed(self, texts: List[str]) -> List[List[float]]:
+        vectors = []
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.connect(self.socket_path)
+            for i in range(0, len(texts), self.max_batch):
+                send_message(sock, json.dumps({'texts': texts[i:i + self.max_batch]}).encode('utf8'))
+                header = json.loads(recv_message(sock))
+                if 'error' in header:
+                    raise RuntimeError(f"Embedding service error: {header['error']}")
+                vectors.extend(np.frombuffer(recv_message(sock), dtype='float32').reshape(header['shape']).tolist())
+        return vectors
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self._embed(list(texts))
+
+    def embed_query(self, text: str) -> List[float]:
+        return self._embed([text])[0]
+
+
+class _Request:
+    def __init__(self, texts):
+        self.texts = texts
+        self.done = threading.Event()
+        self.vectors = None
+        self.error = None
+
+
+class MicroBatcher:
+    """Merges texts of concurrent requests that arrive within `window` seconds into one model call."""
+
+    def __init__(self, embeddings: Embeddings, window=cfg.EMBEDDING_BATCH_WINDOW, max_batch=cfg.EMBEDDING_MAX_BATCH):
+        self.embeddings = embeddings
+        self.window = window
+        self.max_batch = max_batch
+        self.requests = queue.Queue()
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def embed(self, texts: List[str]) -> np.ndarray:
+        request = _Request(texts)
+        self.requests.put(request)
+        request.done.wait()
+        if request.error is not None:
+            raise request.error
+        return request.vectors
+
+    def _collect(self):
+        batch = [self.requests.get()]
+        size = len(batch[0].texts)
+        deadline = timeit.default_timer() + self.window
+        while size < self.max_batch:
+            timeout = deadline - timeit.default_timer()
+            if timeout <= 0:
+                break
+            try:
+                request = self.requests.get(timeout=timeout)
+            except queue.Empty:
+                break
+            batch.append(request)
+            size += len(request.texts)
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            texts = [text for request in batch for text in request.texts]
+            try:
+                vectors = np.asarray(self.embeddings.embed_documents(texts), dtype='float32')
+            except Exception as e:
+                vectors = None
+                for request in batch:
+                    request.error = e
+
+            # Hand every caller its own slice of the batch
+            start = 0
+            for request in batch:
+                if vectors is not None:
+                    request.vectors = vectors[start:start + len(request.texts)]
+                    start += len(request.texts)
+                request.done.set()
@@ -6,13 +6,15 @@
 import streamlit as st
 from langchain.llms import LlamaCpp
 from langchain.callbacks.streaming_stdout import StreamingStdOutCallbackHandler
-from langchain.chains import ConversationalRetrievalChain
 from langchain.prompts import PromptTemplate
 from src.prompts import system_prompt
+from src.budget import BudgetedConversationalRetrievalChain
+from src.memory import ModelMemoryPlan
+from src.speculative import get_llm_threads
+from src.utils import in_streamlit
 from dotenv import find_dotenv, load_dotenv
 import box
 import yaml
-import pickle
 
 # Load environment variables from .env file
 load_dotenv(find_dotenv())
@@ -21,21 +23,34 @@ load_dotenv(find_dotenv())
 with open('config/config.yml', 'r', encoding='utf8') as ymlfile:
     cfg = box.Box(yaml.safe_load(ymlfile))
 
-# Import retriever
-with open(cfg.RETRIEVER_PATH, 'rb') as inp:
-    big_chunk_retriever = pickle.load(inp)
+def build_llm(model_path, length, temp, gpu_layers, n_ctx=cfg.N_CTX):
+    # Check whether the model and its KV cache fit in memory before loading, may lower n_ctx
+    plan = ModelMemoryPlan(model_path, n_ctx)
+    n_ctx = plan.admit()
+    for warning in plan.warnings:
+        print(warning)
+        if in_streamlit():
+            st.warning(warning)
+    if in_streamlit():
+        # Shown in the memory breakdown of the sidebar
+        st.session_state.setdefault('admitted_ctx', {})[model_path] = n_ctx
+
+    # Leave RETRIEVAL_THREADS free for speculative retrieval, prompt processing uses n_threads_batch
+    n_threads = get_llm_threads()
+    model_kwargs = {'n_threads_batch': n_threads} if n_threads else {}
 
-def build_llm(model_path, length, temp, gpu_layers):
     # Local LlamaCpp model, automatically supports multiple model types
     llm = LlamaCpp(model_path=model_path,
                     max_tokens=length, 
                     temperature=temp,
                     n_gpu_layers=gpu_layers,
                     n_batch=128, # ! arbitrary
+                    n_threads=n_threads,
+                    model_kwargs=model_kwargs,
                     callbacks=[StreamingStdOutCallbackHandler()],
                     verbose=False, # suppresses llama_model_loader output
                     streaming=True,
-                    n_ctx=2048, # ! arbitrary
+                    n_ctx=n_ctx,
                     stop=["Question", "Answer", "Helpful"]
                     )
     return llm
@@ -47,26 +62,28 @@ def get_conversation_chain(selected_model,
                            n_sources=None, 
                            vectorstore=None,
                            memory=None,
-                           prompt=None
+                           prompt=None,
+                           budget=None
                            ):
     
     llm = build_llm(model_path=selected_model, length=length, 
                         temp=temp, gpu_layers=gpu_layers)
 
-    # Setup retriever
-    big_chunk_retriever.search_kwargs = {'k': n_sources} # pakt hier wss k=2 child sources, die samen soms minder dan k teruggeven
-    retriever = big_chunk_retriever if not vectorstore else vectorstore.as_retriever(search_kwargs={'k': n_sources})
+    # Setup retriever, parent/child collections return k distinct parent chunks
+    retriever = vectorstore.as_retriever(search_kwargs={'k': n_sources})
     
     systemprompt = PromptTemplate.from_template(system_prompt)
     prompt = PromptTemplate.from_template(prompt)
 
-    conversation_chain = ConversationalRetrievalChain.from_llm(
+    # Without a latency budget this behaves like a regular ConversationalRetrievalChain
+    conversation_chain = BudgetedConversationalRetrievalChain.from_llm(
         llm=llm,
         retriever=retriever,
         return_source_documents=cfg.RETURN_SOURCE_DOCUMENTS,
         combine_docs_chain_kwargs={'prompt': systemprompt},
         condense_question_prompt=prompt,
         memory=memory, 
+        budget=budget,
         )
 
     return conversation_chain
\ No newline at end of file
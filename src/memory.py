@@ -0,0 +1,173 @@
+'''
+===========================================
+        Module: Memory planning
+===========================================
+'''
+import box, yaml, os, struct, functools
+
+# Import config vars
+with open('config/config.yml', 'r', encoding='utf8') as ymlfile:
+    cfg = box.Box(yaml.safe_load(ymlfile))
+
+MB = 1024 ** 2
+
+# struct formats of the fixed size GGUF value types, 8 is a string and 9 an array
+GGUF_VALUE_FORMATS = {0: '<B', 1: '<b', 2: '<H', 3: '<h', 4: '<I', 5: '<i', 6: '<f', 7: '<?', 10: '<Q', 11: '<q', 12: '<d'}
+
+def _read(file, fmt):
+    return struct.unpack(fmt, file.read(struct.calcsize(fmt)))[0]
+
+def _read_string(file, count_format):
+    return file.read(_read(file, count_format)).decode('utf8', errors='replace')
+
+def _read_value(file, value_type, count_format):
+    if value_type == 8:
+        return _read_string(file, count_format)
+    if value_type == 9:
+        # Arrays (e.g. the tokenizer vocabulary) aren't needed, so they are skipped
+        item_type = _read(file, '<I')
+        count = _read(file, count_format)
+        if item_type in GGUF_VALUE_FORMATS:
+            file.seek(struct.calcsize(GGUF_VALUE_FORMATS[item_type]) * count, os.SEEK_CUR)
+        else:
+            for _ in range(count):
+                _read_value(file, item_type, count_format)
+        return None
+    return _read(file, GGUF_VALUE_FORMATS[value_type])
+
+# Read the metadata from the header of a GGUF file, without reading any of the weights.
+# Cached on the modification time, so a replaced model file is read again.
+def read_gguf_metadata(model_path):
+    return _read_gguf_metadata(model_path, os.path.getmtime(model_path))
+
+@functools.lru_cache(maxsize=16)
+def _read_gguf_metadata(model_path, mtime):
+    with open(model_path, 'rb') as file:
+        if file.read(4) != b'GGUF':
+            return {}
+        version = _read(file, '<I')
+        count_format = '<I' if version == 1 else '<Q'
+        _read(file, count_format) # tensor count
+        metadata = {}
+        for _ in range(_read(file, count_format)):
+            key = _read_string(file, count_format)
+            metadata[key] = _read_value(file, _read(file, '<I'), count_format)
+    return metadata
+
+def available_memory():
+    try:
+        import psutil
+        return psutil.virtual_memory().available
+    except ImportError:
+        pass
+    try:
+        with open('/proc/meminfo', 'r') as file:
+            for line in file:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+# Resident memory of the current process
+def process_memory():
+    try:
+        import psutil
+        return psutil.Process().memory_info().rss
+    except ImportError:
+        pass
+    try:
+        with open('/proc/self/status', 'r') as file:
+            for line in file:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+def estimate_embeddings(embeddings):
+    # Embeddings computed by the shared embedding service don't live in this process
+    client = getattr(embeddings, 'client', None)
+    if client is None or not hasattr(client, 'parameters'):
+        return 0
+    return sum(parameter.numel() * parameter.element_size() for parameter in client.parameters())
+
+# Vectors plus stored text of a FAISS store, parent/child index or a sharded combination of both
+def estimate_vectorstore(store):
+    if hasattr(store, 'shards'):
+        return sum(estimate_vectorstore(shard) for shard in store.shards.values())
+    size = store.index.ntotal * store.index.d * 4 if store.index is not None else 0
+    if hasattr(store, 'child_parents'):
+        size += store.child_parents.nbytes
+    if hasattr(store, 'docstore'):
+        size += sum(len(doc.page_content) for doc in getattr(store.docstore, '_dict', {}).values())
+    return size
+
+
+class ModelMemoryPlan:
+    """Estimate of the memory a GGUF model needs for a given context size, checked against available memory.
+
+    Weights are memory-mapped, so they take about the size of the file. The KV cache holds a key
+    and a value vector (f16) per layer for every token of the context.
+    """
+
+    def __init__(self, model_path, n_ctx):
+        self.model_path = model_path
+        self.n_ctx = n_ctx
+        self.warnings = []
+        self.metadata = read_gguf_metadata(model_path)
+        self.available = available_memory()
+
+    def _get(self, key, default=None):
+        architecture = self.metadata.get('general.architecture', 'llama')
+        return self.metadata.get(f'{architecture}.{key}', default)
+
+    def model_bytes(self):
+        return os.path.getsize(self.model_path)
+
+    def kv_cache_bytes(self, n_ctx=None):
+        n_layer = self._get('block_count')
+        n_embd = self._get('embedding_length')
+        n_head = self._get('attention.head_count')
+        if not (n_layer and n_embd and n_head):
+            return 0
+        # Grouped-query attention models have fewer key/value heads than attention heads
+        n_embd_kv = n_embd // n_head * self._get('attention.head_count_kv', n_head)
+        return 2 * n_layer * (n_ctx or self.n_ctx) * n_embd_kv * 2
+
+    def required_bytes(self, n_ctx=None):
+        return self.model_bytes() + self.kv_cache_bytes(n_ctx) + cfg.MEMORY_OVERHEAD_MB * MB
+
+    def fits(self, n_ctx=None):
+        if self.available is None:
+            return True
+        return self.required_bytes(n_ctx) <= self.available - cfg.MEMORY_SAFETY_MB * MB
+
+    def admit(self):
+        """Checks the plan before loading and returns the context size to load the model with.
+
+        If the model doesn't fit, the largest context size (halving down to MEMORY_MIN_CTX) that does fit
+        is suggested, and applied if MEMORY_AUTO_REDUCE_CTX is set. If even that doesn't fit, only a
+        warning is given: the model is still loaded as usual.
+        """
+        if self.fits():
+            return self.n_ctx
+
+        n_ctx = self.n_ctx
+        while n_ctx // 2 >= cfg.MEMORY_MIN_CTX and not self.fits(n_ctx):
+            n_ctx //= 2
+
+        if self.fits(n_ctx):
+            if cfg.MEMORY_AUTO_REDUCE_CTX:
+                self.warnings.append(f"Not enough memory for n_ctx={self.n_ctx}, using n_ctx={n_ctx} instead")
+                self.n_ctx = n_ctx
+            else:
+                self.warnings.append(f"Not enough memory for n_ctx={self.n_ctx}, n_ctx={n_ctx} would fit")
+        else:
+            self.warnings.append(
+                f"{os.path.basename(self.model_path)} needs about {self.required_bytes(n_ctx) // MB} MB but only "
+                f"{self.available // MB} MB is available, expect slow answers or running out of memory. "
+                "Consider unloading other models or choosing a smaller model")
+            if cfg.MEMORY_AUTO_REDUCE_CTX:
+                self.n_ctx = n_ctx
+        return self.n_ctx
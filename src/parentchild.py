@@ -0,0 +1,169 @@
+'''
+===========================================
+        Module: Parent/child index
+===========================================
+'''
+import box, yaml, os, json, sqlite3
+from contextlib import closing
+from typing import Dict, List, Optional
+import faiss
+import numpy as np
+from langchain.schema import Document
+from langchain.text_splitter import RecursiveCharacterTextSplitter
+
+# Import config vars
+with open('config/config.yml', 'r', encoding='utf8') as ymlfile:
+    cfg = box.Box(yaml.safe_load(ymlfile))
+
+
+class ParentChildIndex:
+    """Small child chunks are searched, the bigger parent chunks they belong to are returned.
+
+    Files inside the index folder:
+    - children.faiss: vectors of the child chunks, FAISS ids are the child ids
+    - child_parents.npy: parent id for every child id (-1 once the child is deleted)
+    - parents.sqlite: parent chunks, only fetched from disk for the search results
+    """
+
+    def __init__(self, path, embeddings, parent_splitter=None, child_splitter=None):
+        self.path = path
+        self.embedding_function = embeddings
+        self.parent_splitter = parent_splitter or RecursiveCharacterTextSplitter(
+            chunk_size=cfg.PARENT_CHUNK_SIZE, chunk_overlap=cfg.PARENT_CHUNK_OVERLAP)
+        self.child_splitter = child_splitter or RecursiveCharacterTextSplitter(
+            chunk_size=cfg.CHILD_CHUNK_SIZE, chunk_overlap=cfg.CHILD_CHUNK_OVERLAP)
+        self.index = None
+        self.child_parents = np.empty(0, dtype='int64')
+
+    @property
+    def index_path(self):
+        return os.path.join(self.path, 'children.faiss')
+
+    @property
+    def child_parents_path(self):
+        return os.path.join(self.path, 'child_parents.npy')
+
+    @property
+    def parents_path(self):
+        return os.path.join(self.path, 'parents.sqlite')
+
+    @classmethod
+    def load(cls, path, embeddings, **kwargs):
+        # Returns an empty index if nothing has been saved to the path yet
+        index = cls(path, embeddings, **kwargs)
+        if os.path.isfile(index.index_path):
+            index.index = faiss.read_index(index.index_path)
+            index.child_parents = np.load(index.child_parents_path)
+        return index
+
+    def save(self):
+        # Parents are stored in SQLite, add_documents and delete_sources commit them after saving
+        os.makedirs(self.path, exist_ok=True)
+        if self.index is not None:
+            faiss.write_index(self.index, self.index_path)
+            np.save(self.child_parents_path, self.child_parents)
+
+    def _connect(self):
+        os.makedirs(self.path, exist_ok=True)
+        conn = sqlite3.connect(self.parents_path)
+        conn.execute("CREATE TABLE IF NOT EXISTS parents "
+                     "(id INTEGER PRIMARY KEY AUTOINCREMENT, source TEXT, content TEXT, metadata TEXT)")
+        conn.execute("CREATE INDEX IF NOT EXISTS parents_source ON parents (source)")
+        return conn
+
+    # Sources (file paths) of all documents in the index
+    def get_sources(self) -> List[str]:
+        with closing(self._connect()) as conn:
+            return [row[0] for row in conn.execute("SELECT DISTINCT source FROM parents")]
+
+    def get_parents(self, parent_ids: List[int]) -> Dict[int, Document]:
+        if not parent_ids:
+            return {}
+        placeholders = ','.join('?' * len(parent_ids))
+        with closing(self._connect()) as conn:
+            rows = conn.execute(f"SELECT id, content, metadata FROM parents WHERE id IN ({placeholders})",
+                                parent_ids).fetchall()
+        return {row[0]: Document(page_content=row[1], metadata=json.loads(row[2])) for row in rows}
+
+    # Append documents without touching what is already in the index, returns the number of parents added.
+    # The parents are only committed once their children are saved, so an interrupted build leaves no
+    # parents behind that get_sources() would report as indexed.
+    def add_documents(self, documents: List[Document]) -> int:
+        parents = self.parent_splitter.split_documents(documents)
+        if not parents:
+            return 0
+
+        with closing(self._connect()) as conn, conn:
+            parent_ids = []
+            for parent in parents:
+                cursor = conn.execute("INSERT INTO parents (source, content, metadata) VALUES (?, ?, ?)",
+                                      (parent.metadata.get('source'), parent.page_content, json.dumps(parent.metadata)))
+                parent_ids.append(cursor.lastrowid)
+
+            children, child_parent_ids = [], []
+            for parent_id, parent in zip(parent_ids, parents):
+                for child in self.child_splitter.split_text(parent.page_content):
+                    children.append(child)
+                    child_parent_ids.append(parent_id)
+
+            vectors = np.array(self.embedding_function.embed_documents(children), dtype='float32')
+            if self.index is None:
+                self.index = faiss.IndexIDMap(faiss.IndexFlatL2(vectors.shape[1]))
+
+            # Child ids are positions in child_parents, so they are never reused
+            first_id = len(self.child_parents)
+            self.index.add_with_ids(vectors, np.arange(first_id, first_id + len(children), dtype='int64'))
+            self.child_parents = np.concatenate([self.child_parents, np.array(child_parent_ids, dtype='int64')])
+            self.save()
+        return len(parents)
+
+    # Remove all parents and children of the given sources, returns the number of parents removed.
+    # Like add_documents, the parents table is only committed after the children are saved.
+    def delete_sources(self, sources: List[str]) -> int:
+        if not sources:
+            return 0
+        placeholders = ','.join('?' * len(sources))
+        with closing(self._connect()) as conn, conn:
+            parent_ids = [row[0] for row in conn.execute(
+                f"SELECT id FROM parents WHERE source IN ({placeholders})", sources)]
+            conn.execute(f"DELETE FROM parents WHERE source IN ({placeholders})", sources)
+
+            if parent_ids and self.index is not None:
+                child_ids = np.flatnonzero(np.isin(self.child_parents, parent_ids)).astype('int64')
+                self.index.remove_ids(child_ids)
+                self.child_parents[child_ids] = -1
+                self.save()
+        return len(parent_ids)
+
+    def similarity_search_with_score_by_vector(self, embedding: List[float], k: int = 4,
+                                               fetch_k: Optional[int] = None) -> List[tuple]:
+        if self.index is None or self.index.ntotal == 0:
+            return []
+        query = np.array([embedding], dtype='float32')
+        fetch_k = min(fetch_k or k * 4, self.index.ntotal)
+
+        # Several children can share a parent, keep fetching more children until there are k distinct parents
+        while True:
+            scores, child_ids = self.index.search(query, fetch_k)
+            best = {}
+            for score, child_id in zip(scores[0], child_ids[0]):
+                if child_id == -1:
+                    continue
+                parent_id = int(self.child_parents[child_id])
+                if parent_id not in best:
+                    best[parent_id] = float(score)
+                    if len(best) == k:
+                        break
+            if len(best) == k or fetch_k >= self.index.ntotal:
+                break
+            fetch_k = min(fetch_k * 2, self.index.ntotal)
+
+        parents = self.get_parents(list(best))
+        return [(parents[parent_id], score) for parent_id, score in best.items() if parent_id in parents]
+
+    def similarity_search_with_score(self, query: str, k: int = 4, **kwargs) -> List[tuple]:
+        embedding = self.embedding_function.embed_query(query)
+        return self.similarity_search_with_score_by_vector(embedding, k=k, **kwargs)
+
+    def similarity_search(self, query: str, k: int = 4, **kwargs) -> List[Document]:
+        return [doc for doc, _ in self.similarity_search_with_score(query, k=k, **kwargs)]
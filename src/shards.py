@@ -0,0 +1,133 @@
+'''
+===========================================
+        Module: Sharded vector store
+===========================================
+'''
+import box, yaml, os, heapq
+from concurrent.futures import ThreadPoolExecutor
+import faiss
+from typing import Dict, List, Optional, Union
+from langchain.schema import BaseRetriever, Document
+from langchain.callbacks.manager import CallbackManagerForRetrieverRun
+from langchain.embeddings.base import Embeddings
+from langchain.vectorstores import FAISS
+from src.parentchild import ParentChildIndex
+from src.coarse import CoarseToFineFAISS
+
+# Import config vars
+with open('config/config.yml', 'r', encoding='utf8') as ymlfile:
+    cfg = box.Box(yaml.safe_load(ymlfile))
+
+# Each collection (shard) lives in its own folder inside the vectorstore folder. The default
+# collection is built from the files directly inside the data folder, every other collection
+# from the files inside a data subfolder with the same name.
+def get_collection_paths(name):
+    if name == cfg.DEFAULT_COLLECTION:
+        data_path = cfg.DATA_PATH
+    else:
+        data_path = os.path.join(cfg.DATA_PATH, name)
+    db_path = os.path.join(cfg.VECTORSTORE_PATH, name)
+    return data_path, db_path
+
+# Collections that can be built: the default one plus one for every data subfolder
+def get_data_collections():
+    subfolders = [name for name in os.listdir(cfg.DATA_PATH)
+                  if os.path.isdir(os.path.join(cfg.DATA_PATH, name))]
+    return [cfg.DEFAULT_COLLECTION] + sorted(subfolders)
+
+# Child and parent chunks of a collection are kept in a subfolder next to its regular index
+def get_parent_child_path(name):
+    _, db_path = get_collection_paths(name)
+    return os.path.join(db_path, cfg.PARENT_CHILD_PATH)
+
+# Collections that have been built and can be searched
+def list_collections(childparent=False):
+    if not os.path.isdir(cfg.VECTORSTORE_PATH):
+        return []
+    collections = []
+    for name in sorted(os.listdir(cfg.VECTORSTORE_PATH)):
+        _, db_path = get_collection_paths(name)
+        if childparent:
+            index_file = os.path.join(get_parent_child_path(name), 'children.faiss')
+        else:
+            index_file = os.path.join(db_path, 'index.faiss')
+        if os.path.isfile(index_file):
+            collections.append(name)
+    return collections
+
+def load_collection(name, embeddings, childparent=False):
+    if childparent:
+        return ParentChildIndex.load(get_parent_child_path(name), embeddings)
+    _, db_path = get_collection_paths(name)
+    store = FAISS.load_local(db_path, embeddings)
+    # Only search the chunks of the closest documents, if the document-level index has been built
+    if cfg.COARSE_DOCUMENTS and os.path.isfile(os.path.join(db_path, 'documents.json')):
+        return CoarseToFineFAISS.load(db_path, store, embeddings)
+    return store
+
+def load_collections(names, embeddings, childparent=False):
+    return ShardedFAISS({name: load_collection(name, embeddings, childparent) for name in names}, embeddings)
+
+
+class ShardedFAISS:
+    """Read-only view over several FAISS (or parent/child) collections that are searched in parallel.
+
+    The query is embedded once, every shard is searched in a thread pool (FAISS releases
+    the GIL while searching) and the per-shard hits are merged into a global top-k.
+    All shards must be built with the same embeddings, so their distances are comparable.
+    """
+
+    def __init__(self, shards: Dict[str, Union[FAISS, CoarseToFineFAISS, ParentChildIndex]], embeddings: Embeddings,
+                 max_workers: Optional[int] = None):
+        if not shards:
+            raise ValueError("At least one collection is needed to search in")
+        self.shards = shards
+        self.max_workers = max_workers or cfg.SEARCH_WORKERS
+        # FAISS only keeps a bound embed_query as its embedding_function, so the Embeddings object is passed in
+        self.embeddings = embeddings
+
+    def similarity_search_with_score(self, query: str, k: int = 4, **kwargs) -> List[tuple]:
+        embedding = self.embeddings.embed_query(query)
+        return self.similarity_search_with_score_by_vector(embedding, k=k, **kwargs)
+
+    # `threads` caps the CPU threads of the whole search, they are split over the pool workers
+    def similarity_search_with_score_by_vector(self, embedding: List[float], k: int = 4, threads: Optional[int] = None,
+                                               **kwargs) -> List[tuple]:
+        def search(item):
+            name, shard = item
+            hits = shard.similarity_search_with_score_by_vector(embedding, k=k, **kwargs)
+            for doc, _ in hits:
+                doc.metadata.setdefault('collection', name)
+            return hits
+
+        # No need for a pool when only one shard is selected
+        if len(self.shards) == 1:
+            results = [search(item) for item in self.shards.items()]
+        else:
+            workers = min(self.max_workers, len(self.shards), threads or self.max_workers)
+            # Without a cap every worker would use all cores for FAISS
+            pool_kwargs = {'initializer': faiss.omp_set_num_threads,
+                           'initargs': (max(1, threads // workers),)} if threads else {}
+            with ThreadPoolExecutor(max_workers=workers, **pool_kwargs) as executor:
+                results = list(executor.map(search, self.shards.items()))
+
+        # Lower L2 distance means more similar
+        return heapq.nsmallest(k, (hit for hits in results for hit in hits), key=lambda hit: hit[1])
+
+    def similarity_search(self, query: str, k: int = 4, **kwargs) -> List[Document]:
+        return [doc for doc, _ in self.similarity_search_with_score(query, k=k, **kwargs)]
+
+    # Mirrors VectorStore.as_retriever so it can be used in place of a single FAISS store
+    def as_retriever(self, search_kwargs: Optional[dict] = None):
+        return ShardedRetriever(store=self, search_kwargs=search_kwargs or {})
+
+
+class ShardedRetriever(BaseRetriever):
+    store: ShardedFAISS
+    search_kwargs: dict = {}
+
+    class Config:
+        arbitrary_types_allowed = True
+
+    def _get_relevant_documents(self, query: str, *, run_manager: CallbackManagerForRetrieverRun) -> List[Document]:
+        return self.store.similarity_search(query, **self.search_kwargs)
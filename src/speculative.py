@@ -0,0 +1,118 @@
+'''
+===========================================
+        Module: Speculative retrieval
+===========================================
+'''
+import box, yaml, os, timeit
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional
+import numpy as np
+from langchain.schema import Document
+from src.shards import ShardedFAISS
+
+# Import config vars
+with open('config/config.yml', 'r', encoding='utf8') as ymlfile:
+    cfg = box.Box(yaml.safe_load(ymlfile))
+
+# Hit rate and time saved since the start of the process
+stats = {'hits': 0, 'misses': 0, 'saved': 0.0}
+
+# Split the CPU threads between the LLM and retrieval, so condensing and speculative retrieval
+# don't starve each other. llama.cpp fixes its thread counts when the model is loaded, so this is
+# passed to LlamaCpp. Returns None (llama.cpp default) when speculative retrieval is off.
+def get_llm_threads():
+    if not cfg.SPECULATIVE_RETRIEVAL:
+        return None
+    # Same default as llama_cpp.Llama
+    default = max((os.cpu_count() or 1) // 2, 1)
+    total = cfg.CPU_THREADS or os.cpu_count() or 1
+    return max(1, min(default, total - cfg.RETRIEVAL_THREADS))
+
+# FAISS and torch only use RETRIEVAL_THREADS during the speculative search, the previous counts are restored afterwards
+@contextmanager
+def retrieval_threads():
+    import faiss
+    previous_faiss = faiss.omp_get_max_threads()
+    faiss.omp_set_num_threads(cfg.RETRIEVAL_THREADS)
+    try:
+        import torch
+        previous_torch = torch.get_num_threads()
+        torch.set_num_threads(cfg.RETRIEVAL_THREADS)
+    except ImportError:
+        torch = None
+    try:
+        yield
+    finally:
+        faiss.omp_set_num_threads(previous_faiss)
+        if torch is not None:
+            torch.set_num_threads(previous_torch)
+
+# Function that embeds a query for the store. FAISS on langchain 0.0.315-0.0.319 only keeps a bound
+# embed_query as its embedding_function, the other stores keep the Embeddings object.
+def get_embed_query(store):
+    embeddings = getattr(store, 'embeddings', None)
+    if hasattr(embeddings, 'embed_query'):
+        return embeddings.embed_query
+    embedding_function = getattr(store, 'embedding_function', None)
+    if hasattr(embedding_function, 'embed_query'):
+        return embedding_function.embed_query
+    return embedding_function if callable(embedding_function) else None
+
+
+class SpeculativeRetrieval:
+    """Searches for the raw follow-up question while the LLM condenses it.
+
+    The speculative results are kept when the condensed question embeds close enough to the raw
+    question (cosine similarity of at least SPECULATIVE_MIN_SIMILARITY), otherwise resolve() returns
+    None and the condensed question is searched for through the retriever.
+    """
+
+    def __init__(self, store, embed_query, search_kwargs):
+        self.store = store
+        self.embed_query = embed_query
+        self.search_kwargs = search_kwargs
+        self.question = None
+        self.future = None
+        # One worker per request, so concurrent sessions don't wait for each other's searches
+        self.executor = ThreadPoolExecutor(max_workers=1)
+
+    # Only the search itself counts as time saved, the raw question embedding is needed to compare the questions anyway
+    def _search(self, question):
+        with retrieval_threads():
+            embedding = self.embed_query(question)
+            start = timeit.default_timer()
+            docs = [doc for doc, _ in self.store.similarity_search_with_score_by_vector(
+                embedding, **self.search_kwargs, **self._thread_kwargs())]
+            return embedding, docs, timeit.default_timer() - start
+
+    # Sharded stores search in a pool of their own, which has to stay within the retrieval threads as well
+    def _thread_kwargs(self):
+        return {'threads': cfg.RETRIEVAL_THREADS} if isinstance(self.store, ShardedFAISS) else {}
+
+    def start(self, question):
+        self.question = question
+        self.future = self.executor.submit(self._search, question)
+        # The worker still finishes the search, and exits right after
+        self.executor.shutdown(wait=False)
+
+    def resolve(self, new_question) -> Optional[List[Document]]:
+        embedding, docs, search_time = self.future.result()
+        if new_question.strip() == self.question.strip():
+            similarity = 1.0
+        else:
+            new_embedding = self.embed_query(new_question)
+            similarity = float(np.dot(embedding, new_embedding) /
+                               max(np.linalg.norm(embedding) * np.linalg.norm(new_embedding), 1e-12))
+
+        hit = similarity >= cfg.SPECULATIVE_MIN_SIMILARITY
+        if hit:
+            stats['hits'] += 1
+            stats['saved'] += search_time
+        else:
+            stats['misses'] += 1
+
+        hit_rate = stats['hits'] / (stats['hits'] + stats['misses'])
+        print(f"\nSpeculative retrieval {'hit' if hit else 'miss'} "
+              f"(similarity {similarity:.2f}). Hit rate: {hit_rate:.0%}, time saved: {stats['saved']:.2f} seconds")
+        return docs if hit else None
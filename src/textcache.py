@@ -0,0 +1,62 @@
+'''
+===========================================
+        Module: Extracted text cache
+===========================================
+'''
+import box, yaml, os, json, gzip, hashlib
+from typing import List
+from langchain.schema import Document
+
+# Import config vars
+with open('config/config.yml', 'r', encoding='utf8') as ymlfile:
+    cfg = box.Box(yaml.safe_load(ymlfile))
+
+def file_hash(path):
+    sha = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(1 << 20), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+# Entries are keyed on the loader and the file content, so renamed or moved files are still found
+def get_cache_path(loader_name, digest):
+    return os.path.join(cfg.TEXT_CACHE_PATH, f"{loader_name}-{digest}.jsonl.gz")
+
+# Load the pages of a file from the cache, or with the loader (and add them to the cache) if they aren't cached yet
+def load_pages(path, loader_cls, **loader_kwargs) -> List[Document]:
+    cache_path = get_cache_path(loader_cls.__name__, file_hash(path))
+    if os.path.isfile(cache_path):
+        with gzip.open(cache_path, 'rt', encoding='utf8') as file:
+            records = [json.loads(line) for line in file]
+        return [Document(page_content=record['page_content'], metadata={**record['metadata'], 'source': path})
+                for record in records]
+
+    documents = loader_cls(path, **loader_kwargs).load()
+
+    # One compressed JSON record per page, written to a temporary file first so a crash can't leave half an entry
+    os.makedirs(cfg.TEXT_CACHE_PATH, exist_ok=True)
+    with gzip.open(cache_path + '.tmp', 'wt', encoding='utf8') as file:
+        for doc in documents:
+            file.write(json.dumps({'page_content': doc.page_content, 'metadata': doc.metadata}) + '\n')
+    os.replace(cache_path + '.tmp', cache_path)
+    return documents
+
+# Remove cache entries of files that are no longer in the given folder (or any of its subfolders)
+def prune_cache(data_path=cfg.DATA_PATH):
+    if not os.path.isdir(cfg.TEXT_CACHE_PATH):
+        return 0
+    digests = {file_hash(os.path.join(root, file)) for root, _, files in os.walk(data_path) for file in files}
+    removed = 0
+    for entry in os.listdir(cfg.TEXT_CACHE_PATH):
+        if entry.split('-')[-1].split('.')[0] not in digests:
+            os.remove(os.path.join(cfg.TEXT_CACHE_PATH, entry))
+            removed += 1
+    return removed
+
+def clear_cache():
+    if not os.path.isdir(cfg.TEXT_CACHE_PATH):
+        return 0
+    entries = os.listdir(cfg.TEXT_CACHE_PATH)
+    for entry in entries:
+        os.remove(os.path.join(cfg.TEXT_CACHE_PATH, entry))
+    return len(entries)
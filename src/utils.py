@@ -5,11 +5,15 @@
 '''
 import box, yaml, os, sys
 import streamlit as st
+from streamlit import runtime
+from streamlit.runtime.scriptrunner import get_script_run_ctx
 from langchain.text_splitter import RecursiveCharacterTextSplitter
 from langchain.embeddings import HuggingFaceEmbeddings
-from langchain.document_loaders import PyPDFLoader
+from langchain.document_loaders import PyPDFLoader, Docx2txtLoader, TextLoader
 from langchain.vectorstores import FAISS
 from src.prompts import qa_template
+from src.embedding_service import EmbeddingClient, service_available
+from src.textcache import load_pages
 
 # Import config vars
 with open('config/config.yml', 'r', encoding='utf8') as ymlfile:
@@ -33,18 +37,39 @@ def generate_user_input_options(model_path):
 
     return model_path, files, options_str
 
+# Use the shared embedding service when it is running (see embed_server.py), otherwise load the model in this process
 def load_embeddings():
+    if service_available():
+        return EmbeddingClient()
+    return load_local_embeddings()
+
+def load_local_embeddings():
     embeddings = HuggingFaceEmbeddings(model_name='sentence-transformers/all-MiniLM-L6-v2',
                                        model_kwargs={'device': 'cpu'})
     return embeddings
  
-def get_pdf_text(pdf_docs):
+# Load the text of .pdf, .doc(x) and .txt files inside the source folder, other files are skipped
+def load_documents(source, files):
     documents = []
-    for pdf in pdf_docs:
-        loader = PyPDFLoader(os.path.join('data', pdf.name))
-        documents.extend(loader.load())
+    total_files = len(files)
+
+    for index, file in enumerate(files, start=1):
+        print(f"Loading... {file} - File {index}/{total_files}", end='\r')
+        print(end='\x1b[2K') # clear previous print so no overlap occurs
+
+        # Extracted text is cached, so files are only parsed again when their content changes
+        file_path = os.path.join(source, file)
+        if file.endswith('.pdf'):
+            documents.extend(load_pages(file_path, PyPDFLoader))
+        elif file.endswith('.docx') or file.endswith('.doc'):
+            documents.extend(load_pages(file_path, Docx2txtLoader))
+        elif file.endswith('.txt'):
+            documents.extend(load_pages(file_path, TextLoader, encoding="utf8"))
 
     return documents
+ 
+def get_pdf_text(pdf_docs):
+    return load_documents('data', [pdf.name for pdf in pdf_docs])
 
 def get_text_chunks(docs):
     text_splitter = RecursiveCharacterTextSplitter(chunk_size=cfg.CHUNK_SIZE,
@@ -59,6 +84,16 @@ def get_vectorstore(pdf_docs):
     vectorstore = FAISS.from_documents(texts=text_chunks, embedding=embeddings)
     return vectorstore
 
+# True once the browser session that started the current script run is gone
+# True when running as a Streamlit app, False for the CLI (main.py)
+def in_streamlit():
+    return get_script_run_ctx() is not None and runtime.exists()
+
+def session_closed():
+    if not in_streamlit():
+        return False
+    return not runtime.get_instance().is_active_session(get_script_run_ctx().session_id)
+
 def clear_chat_history():
     st.session_state.my_chat = []
     st.session_state.memory.clear()
@@ -1,4 +1,4 @@
-import box, yaml, time, os
+import box, yaml, time, os, gc
 from dotenv import find_dotenv, load_dotenv
 import streamlit as st
 from streamlit_extras.stateful_chat import chat, add_message
@@ -27,6 +27,7 @@ def main():
                            path=cfg.MODEL_PATH, 
                            show_sources=False)
     main_vis.render()
+    main_vis.render_memory()
     user_csv = main_vis.file
 
     # Setup the chat
@@ -41,6 +42,10 @@ def main():
                 if not user_csv:
                     add_message('assistant', "Upload a CSV file first, please", avatar="🦜")
                 else:
+                    # Unload the previous model first, so two models are never in memory at once
+                    st.session_state.pop('agent', None)
+                    gc.collect()
+
                     llm = build_llm(
                             main_vis.selected_model, 
                             main_vis.length, 
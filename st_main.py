@@ -1,11 +1,12 @@
-import box, yaml, time, timeit, os, sys
+import box, yaml, time, timeit, os, sys, gc
 import streamlit as st
 from streamlit_extras.streaming_write import write
-from langchain.vectorstores import FAISS
 from dotenv import find_dotenv, load_dotenv
 from src.llm import get_conversation_chain
-from src.utils import load_embeddings
+from src.utils import load_embeddings, session_closed
+from src.shards import ShardedFAISS, list_collections, load_collection
 from src.classes import MainVisuals
+from src.budget import LatencyBudget
 
 # Import config vars
 with open('config/config.yml', 'r', encoding='utf8') as ymlfile:
@@ -47,13 +48,25 @@ def main():
     # Set shared streamlit visuals
     main_vis = MainVisuals(title="🦜💬 Chat with database", 
                            path=cfg.MODEL_PATH, 
-                           show_sources=True)
+                           show_sources=True,
+                           collections=list_collections())
     main_vis.render()
 
-    # Setup vectorstore
-    if 'vectorstore' not in st.session_state:
-        embeddings = load_embeddings()
-        st.session_state.vectorstore = FAISS.load_local(cfg.DB_FAISS_PATH, embeddings)
+    if not main_vis.selected_collections:
+        st.warning("Choose at least one collection to search in")
+        st.stop()
+
+    # Setup vectorstore, each collection is only loaded once per session
+    if 'shards' not in st.session_state:
+        st.session_state.shards = {}
+    for name in main_vis.selected_collections:
+        if name not in st.session_state.shards:
+            if 'embeddings' not in st.session_state:
+                st.session_state.embeddings = load_embeddings()
+            st.session_state.shards[name] = load_collection(name, st.session_state.embeddings)
+    st.session_state.vectorstore = ShardedFAISS({name: st.session_state.shards[name] for name in main_vis.selected_collections},
+                                                st.session_state.embeddings)
+    main_vis.render_memory(st.session_state.vectorstore, st.session_state.get('embeddings'))
 
     # Store LLM generated responses
     if 'my_chat' not in st.session_state.keys() or st.session_state.my_chat == []: # if chat not yet initialised or cleared
@@ -65,6 +78,8 @@ def main():
         if 'sources' in message:
             get_sources(msg_id, message['sources'])
             st.write(f":orange[Time to retrieve response: {message['time']}]")
+            if message.get('degradations'):
+                st.write(f":orange[Shortened to fit the latency budget: {', '.join(message['degradations'])}]")
 
     # Make sure previous responses stay in view
     for msg_id, message in enumerate(st.session_state.my_chat):
@@ -84,6 +99,11 @@ def main():
         with st.chat_message('assistant'): 
             with st.spinner("Thinking..."):
                 start = timeit.default_timer()
+                budget = LatencyBudget(main_vis.budget, should_cancel=session_closed) if main_vis.budget else None
+
+                # Unload the previous model first, so two models are never in memory at once
+                st.session_state.pop('conversation', None)
+                gc.collect()
 
               # Create conversation chain
                 st.session_state.conversation = get_conversation_chain(
@@ -94,7 +114,8 @@ def main():
                     main_vis.n_sources, 
                     st.session_state.vectorstore,
                     st.session_state.memory,
-                    st.session_state.prompt 
+                    st.session_state.prompt,
+                    budget
                     )
                 response = st.session_state.conversation(
                     {'question': question}
@@ -120,7 +141,8 @@ def main():
                 time =  f"{round((end-start)/60)} minutes" if (end-start) > 100 else f"{round(end-start)} seconds"
 
             # Add assistant message to conversation
-            message = {'role': 'assistant', 'content': response['answer'], 'sources': source_docs, 'time': time}
+            message = {'role': 'assistant', 'content': response['answer'], 'sources': source_docs, 'time': time, 
+                       'degradations': response['degradations']}
             st.session_state.my_chat.append(message)
             
             show_result(msg_id, placeholder)
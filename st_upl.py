@@ -1,9 +1,11 @@
-import box, yaml, time, timeit, os, sys
+import box, yaml, time, timeit, os, sys, gc
 import streamlit as st
 from streamlit_extras.streaming_write import write
 from dotenv import find_dotenv, load_dotenv
 from src.llm import get_conversation_chain
+from src.utils import session_closed
 from src.classes import MainVisuals
+from src.budget import LatencyBudget
 
 # Import config vars
 with open('config/config.yml', 'r', encoding='utf8') as ymlfile:
@@ -48,6 +50,7 @@ def main():
                            path=cfg.MODEL_PATH, 
                            show_sources=True)
     main_vis.render()
+    main_vis.render_memory(st.session_state.get('vectorstore'))
 
     # Show result in streamlit container
     def show_result(msg_id, container=st):
@@ -55,6 +58,8 @@ def main():
         if 'sources' in message:
             get_sources(msg_id, message['sources'])
             st.write(f":orange[Time to retrieve response: {message['time']}]")
+            if message.get('degradations'):
+                st.write(f":orange[Shortened to fit the latency budget: {', '.join(message['degradations'])}]")
 
     # Store LLM generated responses
     if 'my_chat' not in st.session_state.keys() or st.session_state.my_chat == []: # if chat cleared or not yet initialised
@@ -78,6 +83,11 @@ def main():
         with st.chat_message('assistant'): 
             with st.spinner("Thinking..."):
                 start = timeit.default_timer()
+                budget = LatencyBudget(main_vis.budget, should_cancel=session_closed) if main_vis.budget else None
+
+                # Unload the previous model first, so two models are never in memory at once
+                st.session_state.pop('conversation', None)
+                gc.collect()
 
                 # Create conversation chain
                 st.session_state.conversation = get_conversation_chain(
@@ -88,7 +98,8 @@ def main():
                     main_vis.n_sources, 
                     st.session_state.vectorstore,
                     st.session_state.memory,
-                    st.session_state.prompt 
+                    st.session_state.prompt,
+                    budget
                     )
                 response = st.session_state.conversation(
                     {'question': question}
@@ -114,7 +125,8 @@ def main():
                 time =  f"{round((end-start)/60)} minutes" if (end-start) > 100 else f"{round(end-start)} seconds"
 
             # Add assistant message to conversation
-            message = {'role': 'assistant', 'content': response['answer'], 'sources': source_docs, 'time': time}
+            message = {'role': 'assistant', 'content': response['answer'], 'sources': source_docs, 'time': time, 
+                       'degradations': response['degradations']}
             st.session_state.my_chat.append(message)
             
             show_result(msg_id, placeholder)